@@ -1,3 +1,4 @@
+import json
 import os
 import sys
 import libdnf5
@@ -25,14 +26,40 @@ import libdnf5
 # python3 dnf5.py ensure latest zlib
 
 
+def _is_glob_pattern(pattern):
+    utils = getattr(libdnf5, 'utils', None)
+    if hasattr(utils, 'is_glob_pattern'):
+        return utils.is_glob_pattern(pattern)
+    return any(char in pattern for char in '*?[')
+
+
+def _cmp_for(specs, icase=True):
+    # Use the glob matcher only when needed, exact comparison is cheaper per entry
+    if isinstance(specs, str):
+        specs = [specs]
+    if any(_is_glob_pattern(spec) for spec in specs):
+        return libdnf5.common.QueryCmp_IGLOB if icase else libdnf5.common.QueryCmp_GLOB
+    return libdnf5.common.QueryCmp_IEXACT if icase else libdnf5.common.QueryCmp_EQ
+
+
 class Dnf5AnsibleUsecases:
-    def __init__(self):
+    # Types of the package listings and names of the repositories listing,
+    # both are served from the primary metadata only
+    LISTING_TYPES = ['installed', 'upgrades', 'available']
+    REPO_LISTINGS = ['repos', 'repositories']
+
+    def __init__(self, command=None, args=None):
+        """
+        Args:
+            command (str): Optional usecase to be run, e.g. 'list', used to skip loading unneeded metadata
+            args (list[str]): Optional arguments of the usecase
+        """
         # TODO: To be improved?
         # If callbacks objects are defined inside the local functions,
         # they are garbage collected when going out of the scope.
         # Therefore using this helper container...
-        self.callbacks = set()
-        self.base = self._prepare_base()
+        self.callbacks = []
+        self.base = self._prepare_base(command, args)
         self._prepare_logging()
         self._prepare_repos()
         # Add download callbacks like this:
@@ -45,22 +72,30 @@ class Dnf5AnsibleUsecases:
         match, nevra = query.resolve_pkg_spec(spec, settings, True)
         return match
 
+    def _are_names_installed(self, specs):
+        # Only plain package names are checked here, any other spec form is left to the solver
+        query = libdnf5.rpm.PackageQuery(self.base)
+        query.filter_installed()
+        query.filter_name(specs, libdnf5.common.QueryCmp_EQ)
+        names = {package.get_name() for package in query}
+        return all(spec in names for spec in specs)
+
     def _add_repos_callbacks(self):
         repo_query = libdnf5.repo.RepoQuery(self.base)
         repo_query.filter_enabled(True)
         for repo in repo_query:
             callbacks = RepoCallbacks(repo.get_id())
-            self.callbacks.add(callbacks)
+            self.callbacks.append(callbacks)
             repo.set_callbacks(libdnf5.repo.RepoCallbacksUniquePtr(callbacks))
 
     def _add_downloader_callbacks(self):
         downloader_callbacks = PackageDownloadCallbacks()
-        self.callbacks.add(downloader_callbacks)
+        self.callbacks.append(downloader_callbacks)
         self.base.set_download_callbacks(libdnf5.repo.DownloadCallbacksUniquePtr(downloader_callbacks))
 
     def _add_transaction_callbacks(self, transaction):
         transaction_callbacks = TransactionCallbacks()
-        self.callbacks.add(transaction_callbacks)
+        self.callbacks.append(transaction_callbacks)
         transaction_callbacks_ptr = libdnf5.rpm.TransactionCallbacksUniquePtr(transaction_callbacks)
         transaction.set_callbacks(transaction_callbacks_ptr)
 
@@ -85,39 +120,86 @@ class Dnf5AnsibleUsecases:
             print('Transaction completed successfully.')
         else:
             print(f'Transaction was not successful: {transaction.transaction_result_to_string(result)}')
-            if transaction.get_transaction_problems():
-                print('Following issues happened when executing the transaction:')
-                for log in transaction.get_transaction_problems():
-                    print(log)
+            problems = transaction.get_transaction_problems()
+            if problems:
+                print('Following issues happened when executing the transaction:\n' + '\n'.join(problems))
 
-    def _package_dict(self, package):
+    def _package_dict(self, package, getters=None):
+        # Pass the result of _package_getters() when converting many packages
+        get_name, get_arch, get_epoch, get_release, get_version, get_repo_id = getters or self._package_getters()
         result = {
-            'name': package.get_name(),
-            'arch': package.get_arch(),
-            'epoch': str(package.get_epoch()),
-            'release': package.get_release(),
-            'version': package.get_version(),
-            'repo': package.get_repo_id()}
+            'name': get_name(package),
+            'arch': get_arch(package),
+            'epoch': str(get_epoch(package)),
+            'release': get_release(package),
+            'version': get_version(package),
+            'repo': get_repo_id(package)}
 
         return result
 
+    def _package_getters(self):
+        # Resolve the getters on the class once instead of on every package proxy
+        package_cls = libdnf5.rpm.Package
+        return (
+            package_cls.get_name,
+            package_cls.get_arch,
+            package_cls.get_epoch,
+            package_cls.get_release,
+            package_cls.get_version,
+            package_cls.get_repo_id)
+
+    def _package_columns(self, query):
+        columns = {'name': [], 'arch': [], 'epoch': [], 'release': [], 'version': [], 'repo': []}
+        add_name = columns['name'].append
+        add_arch = columns['arch'].append
+        add_epoch = columns['epoch'].append
+        add_release = columns['release'].append
+        add_version = columns['version'].append
+        add_repo = columns['repo'].append
+        get_name, get_arch, get_epoch, get_release, get_version, get_repo_id = self._package_getters()
+        for package in query:
+            add_name(get_name(package))
+            add_arch(get_arch(package))
+            add_epoch(str(get_epoch(package)))
+            add_release(get_release(package))
+            add_version(get_version(package))
+            add_repo(get_repo_id(package))
+
+        return columns
+
     def _override_base_conf(self, base):
+        overrides = (
+            ('best', True),
+            ('clean_requirements_on_remove', True),
+            ('disable_excludes', []),
+            ('excludepkgs', []),
+            ('gpgcheck', False),
+            ('install_weak_deps', True),
+            ('installroot', '/root/dir/'),
+            ('repo_gpgcheck', False),
+            ('skip_broken', True),
+            ('sslverify', True))
         conf = base.get_config()
-        conf.best = True
-        conf.clean_requirements_on_remove = True
-        conf.disable_excludes = []
-        conf.excludepkgs = []
-        conf.gpgcheck = False
-        conf.install_weak_deps = True
-        conf.installroot = '/root/dir/'
-        conf.repo_gpgcheck = False
-        conf.skip_broken = True
-        conf.sslverify = True
+        for option, value in overrides:
+            setattr(conf, option, value)
 
         vars = base.get_vars()
         vars.set('releasever', '38')
 
-    def _prepare_base(self):
+    def _override_parallel_downloads(self, base):
+        # Let librepo fetch more packages at once, libdnf5 allows at most 20
+        # Keep any value set by the user in the configuration
+        conf = base.get_config()
+        if conf.get_max_parallel_downloads_option().get_priority() == libdnf5.conf.Option.Priority_DEFAULT:
+            conf.max_parallel_downloads = min((os.cpu_count() or 1) * 2, 20)
+
+    def _configure_metadata_types(self, base, command, args):
+        # Package listings by type don't need e.g. comps or updateinfo, skip downloading and loading them
+        # Other usecases keep the configured types, spec matching may need filelists and groups need comps
+        if command == 'list' and args and args[0] in self.LISTING_TYPES + self.REPO_LISTINGS:
+            base.get_config().optional_metadata_types = []
+
+    def _prepare_base(self, command=None, args=None):
         base = libdnf5.base.Base()
 
         # Change config file path like this:
@@ -128,19 +210,24 @@ class Dnf5AnsibleUsecases:
         # Override any configuration options here like this:
         # self._override_base_conf(base)
 
+        # Download more packages in parallel like this:
+        # self._override_parallel_downloads(base)
+
+        self._configure_metadata_types(base, command, args)
+
         base.setup()
 
         return base
 
     def _enable_repos(self, repos):
         repo_query = libdnf5.repo.RepoQuery(self.base)
-        repo_query.filter_id(repos, libdnf5.common.QueryCmp_IGLOB)
+        repo_query.filter_id(repos, _cmp_for(repos))
         for repo in repo_query:
             repo.enable()
 
     def _disable_repos(self, repos):
         repo_query = libdnf5.repo.RepoQuery(self.base)
-        repo_query.filter_id(repos, libdnf5.common.QueryCmp_IGLOB)
+        repo_query.filter_id(repos, _cmp_for(repos))
         for repo in repo_query:
             repo.disable()
 
@@ -169,7 +256,15 @@ class Dnf5AnsibleUsecases:
         # Add repository callbacks like this:
         # self._add_repos_callbacks()
 
-        sack.update_and_load_enabled_repos(True)
+        # Load both the system and available repositories, fall back to
+        # the deprecated API on libdnf5 versions older than 5.2.12.
+        # Keep this a single call: libdnf5 already loads repositories with
+        # a valid local cache while the expired ones are being downloaded,
+        # and the sack cannot be loaded a second time.
+        if hasattr(sack, 'load_repos'):
+            sack.load_repos()
+        else:
+            sack.update_and_load_enabled_repos(True)
 
     def _prepare_logging(self):
         # Enable logging into file defined in configuration
@@ -202,6 +297,50 @@ class Dnf5AnsibleUsecases:
 
         return query.size() > 0
 
+    def _list_packages_query(self, args):
+        cmd = args[0]
+        query = libdnf5.rpm.PackageQuery(self.base)
+        if cmd in self.LISTING_TYPES:
+            filters = {
+                'installed': query.filter_installed,
+                'upgrades': query.filter_upgrades,
+                'available': query.filter_available}
+            filters[cmd]()
+        else:
+            # Match all specs against package names in a single query, case sensitive
+            # the same way as resolve_pkg_spec with the default settings
+            query.filter_name(args, _cmp_for(args, icase=False))
+
+            # Resolve only the specs not matching any name (NEVRAs, provides, files...)
+            unmatched = []
+            for spec in args:
+                spec_query = libdnf5.rpm.PackageQuery(query)
+                spec_query.filter_name([spec], _cmp_for(spec, icase=False))
+                if spec_query.empty():
+                    unmatched.append(spec)
+            if unmatched:
+                resolve_spec_settings = libdnf5.base.ResolveSpecSettings()
+                # Copying a query is cheaper than building a new one from the sack
+                base_query = libdnf5.rpm.PackageQuery(self.base)
+                for spec in unmatched:
+                    spec_query = libdnf5.rpm.PackageQuery(base_query)
+                    spec_query.resolve_pkg_spec(spec, resolve_spec_settings, True)
+                    query.update(spec_query)
+
+        return query
+
+    def _list_items(self, args):
+        if args[0] in self.REPO_LISTINGS:
+            query = libdnf5.repo.RepoQuery(self.base)
+            query.filter_enabled(True)
+            for repo in query:
+                yield {'repoid': repo.get_id(), 'state': 'enabled'}
+        else:
+            query = self._list_packages_query(args)
+            getters = self._package_getters()
+            for package in query:
+                yield self._package_dict(package, getters)
+
     def list(self, args):
         """Package listings usecase
 
@@ -213,25 +352,37 @@ class Dnf5AnsibleUsecases:
         Returns:
             list[dict[str, str]]: List of matching packages in a dict form
         """
-        cmd = args[0]
-        if cmd in ['installed', 'upgrades', 'available']:
-            query = libdnf5.rpm.PackageQuery(self.base)
-            getattr(query, 'filter_' + cmd)()
-            results = [self._package_dict(package) for package in query]
-            return results
-        elif cmd in ['repos', 'repositories']:
-            query = libdnf5.repo.RepoQuery(self.base)
-            query.filter_enabled(True)
-            results = [{'repoid': repo.get_id(), 'state': 'enabled'} for repo in query]
-            return results
-        else:
-            resolve_spec_settings = libdnf5.base.ResolveSpecSettings()
-            results = []
-            for spec in args:
-                query = libdnf5.rpm.PackageQuery(self.base)
-                query.resolve_pkg_spec(spec, resolve_spec_settings, True)
-                results += [self._package_dict(package) for package in query]
-            return results
+        return list(self._list_items(args))
+
+    def list_columns(self, args):
+        """Package listings usecase in a columnar form
+
+        Args:
+            args(list[str]): Arguments in the same form as for `list`, except for the repositories listing
+
+        Returns:
+            dict[str, list[str]]: Package attributes keyed by the attribute name, one value per package
+
+        Raises:
+            ValueError: When the repositories listing is requested
+        """
+        if args[0] in self.REPO_LISTINGS:
+            raise ValueError(f'Listing "{args[0]}" is not supported in a columnar form')
+        query = self._list_packages_query(args)
+        return self._package_columns(query)
+
+    def list_stream(self, args, out=None):
+        """Package listings usecase writing one JSON object per line
+
+        Args:
+            args(list[str]): Arguments in the same form as for `list`
+            out: Text stream to write into, defaults to stdout
+        """
+        if out is None:
+            out = sys.stdout
+        write = out.write
+        for item in self._list_items(args):
+            write(json.dumps(item, separators=(',', ':')) + '\n')
 
     def ensure(self, cmd, specs):
         """Install, update, remove usecase
@@ -240,28 +391,39 @@ class Dnf5AnsibleUsecases:
             cmd (str): Action command to be executed from ['installed', 'present', 'latest', 'absent']
             specs (list[str]): Specs to be processed within the action
         """
+        # Avoid setting up the solver when there is nothing to resolve
+        if not specs and cmd != 'autoremove':
+            print('Nothing to do.')
+            return
+        if cmd in ['installed', 'present'] and self._are_names_installed(specs):
+            print('Nothing to do, all packages are already installed.')
+            return
+
         goal = libdnf5.base.Goal(self.base)
         settings = self._create_goal_job_settings()
 
-        if cmd == 'latest' and specs[0] == '*':
+        if cmd == 'latest' and specs and all(spec == '*' for spec in specs):
             goal.add_rpm_upgrade(settings)
         elif cmd in ['installed', 'present']:
+            add_install = goal.add_install
             for spec in specs:
-                goal.add_install(spec, settings)
+                add_install(spec, settings)
         elif cmd == 'latest':
+            add_upgrade = goal.add_upgrade
             for spec in specs:
                 # Filter only installed packages on update_only like this:
                 # if update_only and self._is_spec_installed(spec):
-                goal.add_upgrade(spec, settings)
+                add_upgrade(spec, settings)
         elif cmd == 'absent':
+            add_remove = goal.add_remove
             for spec in specs:
-                goal.add_remove(spec, settings)
+                add_remove(spec, settings)
         elif cmd == 'autoremove':
             query = libdnf5.rpm.PackageQuery(self.base)
+            # Narrow down to installed packages before the more expensive unneeded check
             query.filter_installed()
             query.filter_unneeded()
-            for pkg in query:
-                goal.add_rpm_remove(pkg, settings)
+            goal.add_rpm_remove(query, settings)
 
         # Apply behavior modifiers like this:
         # goal.set_allow_erasing(True)
@@ -273,7 +435,7 @@ class Dnf5AnsibleUsecases:
         ts_pkgs = transaction.get_transaction_packages()
         if ts_pkgs:
             rpm_sign = libdnf5.rpm.RpmSignature(self.base)
-            for ts_pkg in transaction.get_transaction_packages():
+            for ts_pkg in ts_pkgs:
                 pkg = ts_pkg.get_package()
                 result = rpm_sign.check_package_signature(pkg)
                 if result != libdnf5.rpm.RpmSignature.CheckResult_OK:
@@ -282,18 +444,21 @@ class Dnf5AnsibleUsecases:
 
         # Print any problems during transaction resolving
         if transaction.get_problems():
-            for log_event in transaction.get_resolve_logs():
-                print(f'For spec "{log_event.get_spec()}" an error "{log_event.get_problem()}" occurred during action '
-                      f'"{libdnf5.base.goal_action_to_string(log_event.get_action())}", verbose: "{log_event.to_string()}"')
+            goal_action_to_str = libdnf5.base.goal_action_to_string
+            print('\n'.join(
+                f'For spec "{log_event.get_spec()}" an error "{log_event.get_problem()}" occurred during action '
+                f'"{goal_action_to_str(log_event.get_action())}", verbose: "{log_event.to_string()}"'
+                for log_event in transaction.get_resolve_logs()))
         else:
             print('Transaction resolved correctly.')
 
         # Print transaction summary
         if ts_pkgs:
-            print('Transaction summary:')
-            for pkg in ts_pkgs:
-                print(f'Package "{pkg.get_package().get_nevra()}". '
-                      f'Action "{libdnf5.base.transaction.transaction_item_action_to_string(pkg.get_action())}".')
+            action_to_str = libdnf5.base.transaction.transaction_item_action_to_string
+            summary = [
+                f'Package "{pkg.get_package().get_nevra()}". Action "{action_to_str(pkg.get_action())}".'
+                for pkg in ts_pkgs]
+            print('Transaction summary:\n' + '\n'.join(summary))
         else:
             print('Transaction is empty.')
 
@@ -320,8 +485,10 @@ class PackageDownloadCallbacks(libdnf5.repo.DownloadCallbacks):
 
 # Example implementation of transaction events callbacks
 class TransactionCallbacks(libdnf5.rpm.TransactionCallbacks):
+    action_to_string = staticmethod(libdnf5.base.transaction.transaction_item_action_to_string)
+
     def install_start(self, item, total):
-        action_string = libdnf5.base.transaction.transaction_item_action_to_string(item.get_action())
+        action_string = self.action_to_string(item.get_action())
         package_nevra = item.get_package().get_nevra()
         print(f'{action_string} started for package {package_nevra}')
 
@@ -334,11 +501,10 @@ def main():
     command = sys.argv[1]
     args = sys.argv[2:]
 
-    ansible = Dnf5AnsibleUsecases()
+    ansible = Dnf5AnsibleUsecases(command, args)
 
     if command == 'list':
-        items = ansible.list(args)
-        print(items)
+        ansible.list_stream(args)
     elif command == 'ensure':
         ansible.ensure(args[0], args[1:])
 